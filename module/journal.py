@@ -0,0 +1,179 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2012:
+#    Frederic Mohier, frederic.mohier@gmail.com
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+"""This module provides a segmented write-ahead journal for the packets
+sent to Carbon.
+
+Packets are appended to segment files as length prefixed records. A read
+position tracks the packets already sent and a committed position, saved on
+disk, tracks the packets known to be delivered. Segments before the committed
+position are removed.
+"""
+
+import os
+import struct
+
+from shinken.log import logger
+
+# Record header: packet length
+HEADER = struct.Struct('!L')
+
+
+class Journal(object):
+    def __init__(self, path, segment_size=1048576, max_segments=100):
+        self.path = path
+        self.segment_size = segment_size
+        self.max_segments = max(max_segments, 1)
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+        self.segments = sorted(int(filename.split('.')[0]) for filename in os.listdir(self.path)
+                               if filename.endswith('.journal'))
+        if not self.segments:
+            self.segments = [0]
+
+        # Positions are (segment number, offset in the segment) couples
+        self.committed = self._load_offset()
+        if self.committed[0] not in self.segments:
+            self.committed = (self.segments[0], 0)
+        self.position = self.committed
+
+        self.writer = None
+        self.writer_size = self._repair(self.segments[-1])
+        logger.info("[Graphite] journal %s: %d segment(s), committed position: %s",
+                    self.path, len(self.segments), self.committed)
+
+    def _segment_file(self, segment):
+        return os.path.join(self.path, '%010d.journal' % segment)
+
+    def _load_offset(self):
+        try:
+            with open(os.path.join(self.path, 'offset')) as offset_file:
+                (segment, offset) = offset_file.read().split()
+                return (int(segment), int(offset))
+        except (IOError, ValueError):
+            return (self.segments[0], 0)
+
+    def _save_offset(self):
+        filename = os.path.join(self.path, 'offset')
+        with open(filename + '.tmp', 'w') as offset_file:
+            offset_file.write('%d %d\n' % self.committed)
+        os.rename(filename + '.tmp', filename)
+
+    def _repair(self, segment):
+        """Truncate a segment after its last complete record (interrupted write)
+
+        Returns the segment size
+        """
+        filename = self._segment_file(segment)
+        if not os.path.exists(filename):
+            return 0
+
+        size = 0
+        with open(filename, 'rb') as segment_file:
+            while True:
+                header = segment_file.read(HEADER.size)
+                if len(header) < HEADER.size:
+                    break
+                length = HEADER.unpack(header)[0]
+                if len(segment_file.read(length)) < length:
+                    break
+                size += HEADER.size + length
+
+        if size < os.path.getsize(filename):
+            logger.warning("[Graphite] journal segment %s is truncated to %d bytes", filename, size)
+            with open(filename, 'r+b') as segment_file:
+                segment_file.truncate(size)
+        return size
+
+    def _drop_segments(self):
+        """Remove the oldest segments when the journal is full"""
+        while len(self.segments) > self.max_segments:
+            segment = self.segments.pop(0)
+            os.remove(self._segment_file(segment))
+            logger.warning("[Graphite] journal is full, dropped not sent segment: %d", segment)
+            if self.committed[0] == segment:
+                self.committed = (self.segments[0], 0)
+                self._save_offset()
+            if self.position[0] == segment:
+                self.position = (self.segments[0], 0)
+
+    def append(self, packet):
+        """Append a packet to the journal"""
+        if self.writer_size >= self.segment_size:
+            self.close()
+            self.segments.append(self.segments[-1] + 1)
+            self.writer_size = 0
+            self._drop_segments()
+
+        if self.writer is None:
+            self.writer = open(self._segment_file(self.segments[-1]), 'ab')
+
+        self.writer.write(HEADER.pack(len(packet)) + packet)
+        self.writer.flush()
+        self.writer_size += HEADER.size + len(packet)
+
+    def pending(self):
+        """Is there some packets not yet read?"""
+        return self.position != (self.segments[-1], self.writer_size)
+
+    def read(self, count):
+        """Read at most count packets from the current position and move the position forward"""
+        packets = []
+        while len(packets) < count and self.pending():
+            (segment, offset) = self.position
+            with open(self._segment_file(segment), 'rb') as segment_file:
+                segment_file.seek(offset)
+                while len(packets) < count:
+                    header = segment_file.read(HEADER.size)
+                    if len(header) < HEADER.size:
+                        break
+                    length = HEADER.unpack(header)[0]
+                    packets.append(segment_file.read(length))
+                    offset += HEADER.size + length
+
+            if self.position == (segment, offset) and segment < self.segments[-1]:
+                # End of a previous segment
+                self.position = (self.segments[self.segments.index(segment) + 1], 0)
+            else:
+                self.position = (segment, offset)
+        return packets
+
+    def commit(self, position=None):
+        """Commit a read position (default is current position) and remove the delivered segments"""
+        if position is None:
+            position = self.position
+        if position == self.committed:
+            return
+
+        self.committed = position
+        self._save_offset()
+        while self.segments[0] < self.committed[0]:
+            os.remove(self._segment_file(self.segments.pop(0)))
+
+    def rewind(self):
+        """Read again from the committed position"""
+        self.position = self.committed
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
@@ -28,16 +28,35 @@ to brok information of the service/host perfdatas into the Graphite
 backend. http://graphite.wikidot.com/start
 """
 
+import os
 import re
 import time
-
-from socket import socket
+import errno
+import signal
+import fcntl
+import select
+import struct
+import termios
+import zlib
+
+from socket import socket, getdefaulttimeout, MSG_PEEK, SOL_SOCKET, SO_ERROR
 from collections import deque
+from Queue import Empty
+from itertools import chain, izip
 
 from shinken.basemodule import BaseModule
 from shinken.log import logger
 from shinken.misc.perfdata import PerfDatas
 
+# lz4 is an optional dependency for compressed transport
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+from journal import Journal
+from profiling import Profiler
+
 properties = {
     'daemons': ['broker'],
     'type': 'graphite_perfdata',
@@ -81,6 +100,79 @@ class Graphite_broker(BaseModule):
         logger.info('[Graphite] Configuration - maximum cache commit volume: %d packets', self.cache_commit_volume)
         self.cache = deque(maxlen=self.cache_max_length)
 
+        # Connect asynchronously, broks are processed and cached until the connection is established
+        self.lazy_connect = bool(int(getattr(modconf, 'lazy_connect', '0')))
+        logger.info('[Graphite] Configuration - lazy connection: %d', self.lazy_connect)
+        # Socket of an in progress asynchronous connection
+        self.connecting = None
+
+        # Maximum time for sending the pending data when the module stops. The broker kills the
+        # module 1 second after asking it to stop, keep some time to spool the data not sent
+        self.shutdown_timeout = float(getattr(modconf, 'shutdown_timeout', '0.5'))
+        logger.info('[Graphite] Configuration - shutdown timeout: %.1f seconds', self.shutdown_timeout)
+        # Directory where the data still not sent when the module stops are spooled
+        self.spool_path = getattr(modconf, 'spool_path', '')
+        logger.info('[Graphite] Configuration - spool: %s', self.spool_path or 'disabled')
+
+        # Compressed transport for Carbon relays accepting compressed streams
+        self.compression = getattr(modconf, 'compression', 'none').lower()
+        # lz4 levels >= 3 select the slow high compression mode, default to the fast mode
+        self.compression_level = int(getattr(modconf, 'compression_level',
+                                             '0' if self.compression == 'lz4' else '6'))
+        if self.compression not in ('none', 'gzip', 'lz4'):
+            logger.error("[Graphite] Configuration - unknown compression: %s, data will not be compressed",
+                         self.compression)
+            self.compression = 'none'
+        if self.compression == 'lz4' and lz4 is None:
+            logger.error("[Graphite] Configuration - lz4 compression requires the lz4 Python library,"
+                         " data will not be compressed")
+            self.compression = 'none'
+        logger.info("[Graphite] Configuration - compression: %s (level %d)", self.compression, self.compression_level)
+        # Compression stream of the current connection
+        self.compressor = None
+        # lz4 frame header not yet sent on the current connection
+        self.frame_header = ''
+
+        # Journal: packets are stored on disk and removed only when Carbon acknowledged them
+        self.journal = None
+        journal_path = getattr(modconf, 'journal_path', '')
+        if journal_path and not self.acknowledgement_available():
+            logger.error("[Graphite] Configuration - the journal requires the TIOCOUTQ ioctl (Linux) to know"
+                         " the data acknowledged by Carbon, journal is disabled")
+            journal_path = ''
+        if journal_path:
+            self.journal = Journal(journal_path,
+                                   int(getattr(modconf, 'journal_segment_size', '1048576')),
+                                   int(getattr(modconf, 'journal_max_segments', '100')))
+        logger.info('[Graphite] Configuration - journal: %s', journal_path or 'disabled')
+        # Bytes sent on the current connection and (sent bytes, journal position) marks
+        self.sent_bytes = 0
+        self.journal_marks = deque()
+
+        # Packets spooled when the module stopped, loaded once the cache and the journal are set up
+        if self.spool_path and os.path.isdir(self.spool_path):
+            self.load_spool()
+
+        # Hot path profiling: stages timing histograms and cProfile capture on SIGUSR2
+        self.profiler = None
+        profile_file = getattr(modconf, 'profile_file', '')
+        if profile_file:
+            self.profiler = Profiler(profile_file,
+                                     int(getattr(modconf, 'profile_interval', '60')),
+                                     int(getattr(modconf, 'profile_duration', '30')))
+            self.prepare_brok = self.profiler.wrap('prepare', self.prepare_brok)
+            self.get_metric_and_value = self.profiler.wrap('parse', self.get_metric_and_value)
+            self.get_service_names = self.profiler.wrap('path', self.get_service_names)
+            self.get_host_names = self.profiler.wrap('path', self.get_host_names)
+            self.send_packet = self.profiler.wrap('send', self.send_packet)
+        logger.info('[Graphite] Configuration - profiling: %s', profile_file or 'disabled')
+
+        # Batch mode: all the metrics of a broks message are sent in one packet
+        self.batch_broks = bool(int(getattr(modconf, 'batch_broks', '0')))
+        logger.info('[Graphite] Configuration - batch broks messages: %d', self.batch_broks)
+        # Current batch columns: (names, values, timestamps)
+        self.batch = None
+
         # Used to reset check time into the scheduled time.
         # Carbon/graphite does not like latency data and creates blanks in graphs
         # Every data with "small" latency will be considered create at scheduled time
@@ -122,54 +214,249 @@ class Graphite_broker(BaseModule):
         self.send_max = bool(getattr(modconf, 'send_max', False))
         logger.info("[Graphite] Configuration - send max metrics: %d", self.send_max)
 
+        # Cardinality guard: maximum number of distinct metrics for an host/service
+        self.max_metrics_per_service = int(getattr(modconf, 'max_metrics_per_service', '0'))
+        logger.info("[Graphite] Configuration - maximum metrics per service: %d", self.max_metrics_per_service)
+        # Known metrics names for each host/service and hosts/services already warned about
+        self.metrics_names = {}
+        self.cardinality_warned = set()
+
+        # Rate limit: metrics per second for an host (token bucket)
+        self.host_rate_limit = float(getattr(modconf, 'host_rate_limit', '0'))
+        self.host_rate_burst = float(getattr(modconf, 'host_rate_burst', '0')) or self.host_rate_limit * 60
+        if self.host_rate_limit and self.host_rate_burst < 1:
+            # A bucket holding less than one token never allows a metric
+            logger.warning("[Graphite] Configuration - host rate burst %.2f is lower than 1 metric, using 1",
+                           self.host_rate_burst)
+            self.host_rate_burst = 1.0
+        logger.info("[Graphite] Configuration - host rate limit: %.2f metrics/s, burst: %d metrics",
+                    self.host_rate_limit, self.host_rate_burst)
+        # Tokens buckets for each host: [tokens, last update time, last warning time]
+        self.rate_buckets = {}
+
+        # Dropped metrics counters
+        self.dropped_metrics = {'cardinality': 0, 'rate': 0}
+
+        # Send check results metadata: state, latency, execution time
+        # Each item is a (metric name, brok data key) couple
+        self.metadata_metrics = []
+        for (parameter, metric, key) in (('send_state', 'shinken_state', 'state_id'),
+                                         ('send_latency', 'shinken_latency', 'latency'),
+                                         ('send_execution_time', 'shinken_execution_time', 'execution_time')):
+            if bool(int(getattr(modconf, parameter, '0'))):
+                self.metadata_metrics.append((metric, key))
+        logger.info("[Graphite] Configuration - send metadata metrics: %s",
+                    [metric for (metric, _) in self.metadata_metrics])
+
+        # Graphite 1.1 tagged series (metric;host=...;service=...) instead of dotted paths
+        self.graphite_tags = bool(int(getattr(modconf, 'graphite_tags', '0')))
+        logger.info("[Graphite] Configuration - send tagged series: %d", self.graphite_tags)
+
+        # Specific filter for tags values: no ';' and no spaces (plaintext protocol separator)
+        self.illegal_char_tag = re.compile(r'[;\s]')
+
     # Called by Broker so we can do init stuff
-    def init(self):
+    def init(self, timeout=None):
+        """Connect to Carbon, the blocking connection waits at most timeout seconds if set"""
         logger.info("[Graphite] initializing connection to %s:%d ...", str(self.host), self.port)
+        self.sent_bytes = 0
+        self.journal_marks.clear()
+        if self.journal:
+            # Not acknowledged packets are sent again on the new connection
+            self.journal.rewind()
+
+        if self.compression == 'gzip':
+            # A new gzip stream for each connection
+            self.compressor = zlib.compressobj(self.compression_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        elif self.compression == 'lz4':
+            # A new lz4 frame for each connection, blocks are linked to use the previous packets
+            self.compressor = lz4.frame.LZ4FrameCompressor(compression_level=self.compression_level,
+                                                           block_linked=True, auto_flush=True)
+            # Sent with the first packet
+            self.frame_header = self.compressor.begin()
+
         try:
-            self.con = socket()
-            self.con.connect((self.host, self.port))
+            if self.lazy_connect:
+                # Do not wait for the connection to be established, see check_connection
+                self.con = None
+                self.connecting = socket()
+                self.connecting.setblocking(0)
+                error = self.connecting.connect_ex((self.host, self.port))
+                if error not in (0, errno.EINPROGRESS):
+                    raise IOError(error, os.strerror(error))
+            else:
+                self.con = socket()
+                if timeout is not None:
+                    self.con.settimeout(timeout)
+                self.con.connect((self.host, self.port))
+                self.con.settimeout(getdefaulttimeout())
         except IOError as exp:
             logger.error("[Graphite] Graphite Carbon instance connexion failed IOError: %s", str(exp))
             # do not raise an exception - logging is enough ...
             self.con = None
+            if self.connecting:
+                self.connecting.close()
+                self.connecting = None
 
         return self.con
 
+    def check_connection(self, timeout=0):
+        """Check if the asynchronous connection is established, waiting at most timeout seconds"""
+        try:
+            _, writable, _ = select.select([], [self.connecting], [], timeout)
+            if not writable:
+                return None
+            error = self.connecting.getsockopt(SOL_SOCKET, SO_ERROR)
+            if error:
+                raise IOError(error, os.strerror(error))
+        except (IOError, select.error) as exp:
+            logger.error("[Graphite] Graphite Carbon instance connexion failed IOError: %s", str(exp))
+            self.connecting.close()
+            self.connecting = None
+            return None
+
+        logger.info("[Graphite] connected to %s:%d", str(self.host), self.port)
+        self.connecting.settimeout(getdefaulttimeout())
+        self.con = self.connecting
+        self.connecting = None
+        return self.con
+
+    def connect(self):
+        """Get the Carbon connection, (re)connecting if needed"""
+        if not self.con:
+            if self.connecting:
+                self.check_connection()
+            else:
+                self.init()
+        return self.con
+
     def do_loop_turn(self):
         return True
 
+    def send_data(self, data):
+        """Send data to Carbon, compressed if configured. Returns the number of sent bytes"""
+        if self.compression == 'gzip':
+            # Sync flush so that the receiver can decompress the data now
+            data = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        elif self.compression == 'lz4':
+            # Auto flush so that the receiver can decompress the data now
+            data = self.frame_header + self.compressor.compress(data)
+            self.frame_header = ''
+
+        self.con.sendall(data)
+        return len(data)
+
+    def connection_alive(self):
+        """Check that the Carbon connection was not closed or reset by the peer"""
+        try:
+            # Carbon never sends anything, so a readable socket is a closed one
+            readable, _, _ = select.select([self.con], [], [], 0)
+            if readable and not self.con.recv(1, MSG_PEEK):
+                return False
+        except (IOError, select.error):
+            return False
+        return True
+
+    def unacknowledged_bytes(self):
+        """Get the number of sent bytes not yet acknowledged by Carbon (Linux only), None if unknown"""
+        try:
+            return struct.unpack('i', fcntl.ioctl(self.con.fileno(), termios.TIOCOUTQ, '\0' * 4))[0]
+        except IOError:
+            return None
+
+    @staticmethod
+    def acknowledgement_available():
+        """Check that the sent bytes not yet acknowledged can be known on this system"""
+        probe = socket()
+        try:
+            fcntl.ioctl(probe.fileno(), termios.TIOCOUTQ, '\0' * 4)
+            return True
+        except (AttributeError, IOError):
+            return False
+        finally:
+            probe.close()
+
+    def commit_journal(self):
+        """Commit the journal position of the packets acknowledged by Carbon"""
+        unacknowledged = self.unacknowledged_bytes()
+        if unacknowledged is None:
+            # Unknown, the packets are sent again from the committed position on the next connection
+            return
+        acknowledged = self.sent_bytes - unacknowledged
+
+        position = None
+        while self.journal_marks and self.journal_marks[0][0] <= acknowledged:
+            position = self.journal_marks.popleft()[1]
+        if position is not None:
+            self.journal.commit(position)
+
+    def send_journal(self):
+        """Send the journal pending packets. In case of failure, the packets are sent again
+        from the last committed position when the connection is restored."""
+        if self.con and not self.connection_alive():
+            logger.warning("[Graphite] Connection closed by the Graphite Carbon instance!"
+                           " Sending again not acknowledged packets ...")
+            self.con.close()
+            self.con = None
+
+        if not self.connect():
+            logger.warning("[Graphite] Connection to the Graphite Carbon instance is broken!"
+                           " Data stored in the journal ... ")
+            return False
+
+        self.commit_journal()
+
+        packets = self.journal.read(self.cache_commit_volume)
+        for packet in packets:
+            try:
+                self.sent_bytes += self.send_data(packet)
+                logger.debug("[Graphite] Data sent to Carbon: \n%s", packet)
+            except IOError:
+                logger.warning("[Graphite] Failed sending data to the Graphite Carbon instance !"
+                               " Data stored in the journal ... ")
+                self.con = None
+                return False
+        if packets:
+            self.journal_marks.append((self.sent_bytes, self.journal.position))
+
+        return True
+
+    def flush_cache(self):
+        """Send at most cache_commit_volume cached packets. Returns False if sending failed"""
+        logger.info("[Graphite] %d cached metrics packet(s) to send to Graphite", len(self.cache))
+        commit_count = 0
+        now = time.time()
+        while self.cache and commit_count < self.cache_commit_volume:
+            packet = self.cache.popleft()
+            try:
+                self.send_data(packet)
+                commit_count = commit_count + 1
+            except Exception as exp:
+                logger.error("[Graphite] cache flushing exception: %s", str(exp))
+                # Keep the packet for the next connection
+                self.cache.appendleft(packet)
+                self.con = None
+                break
+        logger.info("[Graphite] time to flush %d cached metrics packet(s) (%2.4f)",
+                    commit_count, time.time() - now)
+
+        return self.con is not None
+
     # Sending data to Carbon. In case of failure, try to reconnect and send again.
     def send_packet(self, packet):
-        if not self.con:
-            self.init()
+        if self.journal:
+            self.journal.append(packet)
+            return self.send_journal()
 
-        if not self.con:
+        if not self.connect() or (self.cache and not self.flush_cache()):
             logger.warning("[Graphite] Connection to the Graphite Carbon instance is broken!"
                            " Storing data in module cache ... ")
             self.cache.append(packet)
             logger.warning("[Graphite] cached metrics %d packets", len(self.cache))
             return False
 
-        if self.cache:
-            logger.info("[Graphite] %d cached metrics packet(s) to send to Graphite", len(self.cache))
-            commit_count = 0
-            now = time.time()
-            while True:
-                try:
-                    self.con.sendall(self.cache.popleft())
-                    commit_count = commit_count + 1
-                    if commit_count >= self.cache_commit_volume:
-                        break
-                except IndexError:
-                    logger.debug("[Graphite] sent all cached metrics")
-                    break
-                except Exception as exp:
-                    logger.error("[Graphite] cache flushing exception: %s", str(exp))
-            logger.info("[Graphite] time to flush %d cached metrics packet(s) (%2.4f)",
-                        commit_count, time.time() - now)
-
         try:
-            self.con.sendall(packet)
+            self.send_data(packet)
             logger.debug("[Graphite] Data sent to Carbon: \n%s", packet)
         except IOError:
             logger.warning("[Graphite] Failed sending data to the Graphite Carbon instance !"
@@ -181,6 +468,28 @@ class Graphite_broker(BaseModule):
 
         return True
 
+    @staticmethod
+    def render_packet(names, values, timestamps):
+        """Render the plaintext packet for the metrics names, values and timestamps columns
+
+        The whole packet is formatted at once with a repeated line template.
+        """
+        line = "%s %s %d\n"
+        return (line * len(names)) % tuple(chain.from_iterable(izip(names, values, timestamps))) + "\n"
+
+    def send_metrics(self, names, values, timestamp):
+        """Send metrics sharing the same timestamp
+
+        If a batch is in progress, the metrics are only appended to the batch columns
+        """
+        if self.batch is not None:
+            self.batch[0].extend(names)
+            self.batch[1].extend(values)
+            self.batch[2].extend([timestamp] * len(names))
+            return
+
+        self.send_packet(self.render_packet(names, values, [timestamp] * len(names)))
+
     def get_metric_and_value(self, service, perf_data):
         result = []
         metrics = PerfDatas(perf_data)
@@ -219,6 +528,149 @@ class Graphite_broker(BaseModule):
 
         return result
 
+    def guard_cardinality(self, key, couples):
+        """Drop the metrics of an host/service exceeding its maximum number of distinct metrics"""
+        if not self.max_metrics_per_service:
+            return couples
+
+        known = self.metrics_names.setdefault(key, set())
+        allowed = []
+        for couple in couples:
+            if couple[0] not in known:
+                if len(known) >= self.max_metrics_per_service:
+                    continue
+                known.add(couple[0])
+            allowed.append(couple)
+
+        dropped = len(couples) - len(allowed)
+        if dropped:
+            if key not in self.cardinality_warned:
+                self.cardinality_warned.add(key)
+                logger.warning("[Graphite] %s has more than %d distinct metrics, new metrics are dropped",
+                               key, self.max_metrics_per_service)
+            self.dropped_metrics['cardinality'] += dropped
+            logger.debug("[Graphite] %s: dropped %d metric(s) (%d dropped metrics)",
+                         key, dropped, self.dropped_metrics['cardinality'])
+        return allowed
+
+    def limit_rate(self, host_name, couples):
+        """Drop the metrics of an host exceeding its rate limit"""
+        if not self.host_rate_limit:
+            return couples
+
+        now = time.time()
+        if host_name not in self.rate_buckets:
+            self.rate_buckets[host_name] = [self.host_rate_burst, now, 0]
+        bucket = self.rate_buckets[host_name]
+        bucket[0] = min(self.host_rate_burst, bucket[0] + (now - bucket[1]) * self.host_rate_limit)
+        bucket[1] = now
+
+        allowed = min(len(couples), int(bucket[0]))
+        bucket[0] -= allowed
+        if allowed < len(couples):
+            self.dropped_metrics['rate'] += len(couples) - allowed
+            # Do not warn more than once a minute for an host
+            if now - bucket[2] > 60:
+                logger.warning("[Graphite] %s exceeds its rate limit of %.2f metrics/s, metrics are dropped"
+                               " (%d dropped metrics)", host_name, self.host_rate_limit, self.dropped_metrics['rate'])
+                bucket[2] = now
+        return couples[:allowed]
+
+    def get_metadata_metrics(self, data):
+        """Get the configured check result metadata (state, latency, ...) as metrics couples"""
+        return [(metric, data[key]) for (metric, key) in self.metadata_metrics]
+
+    def get_tags(self, host_name, service_description=None, post=None):
+        """Build the tags string (;tag=value;...) of an host or a service.
+
+        Tags values are sanitized according to the Graphite rules: they must not be empty,
+        must not contain ';' and must not start with '~'
+        """
+        tags = [('host', host_name)]
+        if '_GRAPHITE_GROUP' in self.hosts_cache.get(host_name, {}):
+            tags.append(('group', self.hosts_cache[host_name]['_GRAPHITE_GROUP']))
+        if service_description:
+            tags.append(('service', service_description))
+        if post:
+            tags.append(('post', post))
+
+        result = ''
+        for (tag, value) in tags:
+            value = self.illegal_char_tag.sub('_', value).lstrip('~')
+            if value:
+                result += ';%s=%s' % (tag, value)
+        return result
+
+    def get_tagged_prefix(self, host_name):
+        """Get the prefix to use before a tagged series metric name"""
+        parts = []
+        if '_GRAPHITE_PRE' in self.hosts_cache[host_name]:
+            parts.append(self.hosts_cache[host_name]['_GRAPHITE_PRE'])
+        if self.graphite_data_source:
+            parts.append(self.graphite_data_source)
+        if not parts:
+            return ''
+        return '.'.join(parts) + '.'
+
+    def get_service_names(self, host_name, service_description, couples):
+        """Get the Graphite names of a service metrics"""
+        service_id = host_name + "/" + service_description
+        if self.graphite_tags:
+            # Tagged series: the tags string is prepared when the service is cached
+            prefix = self.get_tagged_prefix(host_name)
+            tags = self.services_cache[service_id]['_TAGS']
+            names = [prefix + metric + tags for (metric, _) in couples]
+        else:
+            # Custom hosts variables
+            hname = self.illegal_char_hostname.sub('_', host_name)
+            if '_GRAPHITE_GROUP' in self.hosts_cache[host_name]:
+                hname = ".".join((self.hosts_cache[host_name]['_GRAPHITE_GROUP'], hname))
+
+            if '_GRAPHITE_PRE' in self.hosts_cache[host_name]:
+                hname = ".".join((self.hosts_cache[host_name]['_GRAPHITE_PRE'], hname))
+
+            # Custom services variables
+            desc = self.illegal_char_hostname.sub('_', service_description)
+            if '_GRAPHITE_POST' in self.services_cache[service_id]:
+                desc = ".".join((desc, self.services_cache[service_id]['_GRAPHITE_POST']))
+
+            # Graphite data source
+            if self.graphite_data_source:
+                path = '.'.join((hname, self.graphite_data_source, desc))
+            else:
+                path = '.'.join((hname, desc))
+
+            names = [path + '.' + metric for (metric, _) in couples]
+        return names
+
+    def get_host_names(self, host_name, couples):
+        """Get the Graphite names of an host metrics"""
+        if self.graphite_tags:
+            # Tagged series: the tags string is prepared when the host is cached
+            prefix = self.get_tagged_prefix(host_name)
+            tags = self.hosts_cache[host_name]['_TAGS']
+            names = [prefix + metric + tags for (metric, _) in couples]
+        else:
+            # Custom hosts variables
+            hname = self.illegal_char_hostname.sub('_', host_name)
+            if '_GRAPHITE_GROUP' in self.hosts_cache[host_name]:
+                hname = ".".join((self.hosts_cache[host_name]['_GRAPHITE_GROUP'], hname))
+
+            if '_GRAPHITE_PRE' in self.hosts_cache[host_name]:
+                hname = ".".join((self.hosts_cache[host_name]['_GRAPHITE_PRE'], hname))
+
+            if self.hostcheck:
+                hname = '.'.join((hname, self.hostcheck))
+
+            # Graphite data source
+            if self.graphite_data_source:
+                path = '.'.join((hname, self.graphite_data_source))
+            else:
+                path = hname
+
+            names = [path + '.' + metric for (metric, _) in couples]
+        return names
+
     # Prepare service cache
     def manage_initial_service_status_brok(self, b):
         host_name = b.data['host_name']
@@ -234,6 +686,10 @@ class Graphite_broker(BaseModule):
         if '_GRAPHITE_POST' in b.data['customs']:
             self.services_cache[service_id]['_GRAPHITE_POST'] = b.data['customs']['_GRAPHITE_POST']
 
+        if self.graphite_tags:
+            self.services_cache[service_id]['_TAGS'] = self.get_tags(
+                host_name, service_description, self.services_cache[service_id].get('_GRAPHITE_POST'))
+
         logger.debug("[Graphite] initial service status received: %s", service_id)
 
     # Prepare host cache
@@ -247,6 +703,9 @@ class Graphite_broker(BaseModule):
         if '_GRAPHITE_GROUP' in b.data['customs']:
             self.hosts_cache[host_name]['_GRAPHITE_GROUP'] = b.data['customs']['_GRAPHITE_GROUP']
 
+        if self.graphite_tags:
+            self.hosts_cache[host_name]['_TAGS'] = self.get_tags(host_name, self.hostcheck)
+
         logger.debug("[Graphite] initial host status received: %s", host_name)
 
     # A service check result brok has just arrived ...
@@ -271,25 +730,16 @@ class Graphite_broker(BaseModule):
 
         # Decode received metrics
         couples = self.get_metric_and_value(service_description, b.data['perf_data'])
+        couples = self.guard_cardinality(service_id, couples)
+        # Rate limit the perfdata metrics only, the metadata metrics are always sent
+        couples = self.limit_rate(host_name, couples)
+        couples.extend(self.get_metadata_metrics(b.data))
 
         # If no values, we can exit now
         if not couples:
             logger.debug("[Graphite] no metrics to send ...")
             return
 
-        # Custom hosts variables
-        hname = self.illegal_char_hostname.sub('_', host_name)
-        if '_GRAPHITE_GROUP' in self.hosts_cache[host_name]:
-            hname = ".".join((self.hosts_cache[host_name]['_GRAPHITE_GROUP'], hname))
-
-        if '_GRAPHITE_PRE' in self.hosts_cache[host_name]:
-            hname = ".".join((self.hosts_cache[host_name]['_GRAPHITE_PRE'], hname))
-
-        # Custom services variables
-        desc = self.illegal_char_hostname.sub('_', service_description)
-        if '_GRAPHITE_POST' in self.services_cache[service_id]:
-            desc = ".".join((desc, self.services_cache[service_id]['_GRAPHITE_POST']))
-
         # Checks latency
         if self.ignore_latency_limit >= b.data['latency'] > 0:
             check_time = int(b.data['last_chk']) - int(b.data['latency'])
@@ -298,20 +748,10 @@ class Graphite_broker(BaseModule):
         else:
             check_time = int(b.data['last_chk'])
 
-        # Graphite data source
-        if self.graphite_data_source:
-            path = '.'.join((hname, self.graphite_data_source, desc))
-        else:
-            path = '.'.join((hname, desc))
+        names = self.get_service_names(host_name, service_description, couples)
 
-        lines = []
         # Send a bulk of all metrics at once
-        for (metric, value) in couples:
-            lines.append("%s.%s %s %d" % (path, metric, str(value), check_time))
-        lines.append("\n")
-        packet = '\n'.join(lines)
-
-        self.send_packet(packet)
+        self.send_metrics(names, [value for (_, value) in couples], check_time)
 
     # A host check result brok has just arrived, we UPDATE data info with this
     def manage_host_check_result_brok(self, b):
@@ -325,23 +765,16 @@ class Graphite_broker(BaseModule):
 
         # Decode received metrics
         couples = self.get_metric_and_value('host_check', b.data['perf_data'])
+        couples = self.guard_cardinality(host_name, couples)
+        # Rate limit the perfdata metrics only, the metadata metrics are always sent
+        couples = self.limit_rate(host_name, couples)
+        couples.extend(self.get_metadata_metrics(b.data))
 
         # If no values, we can exit now
         if not couples:
             logger.debug("[Graphite] no metrics to send ...")
             return
 
-        # Custom hosts variables
-        hname = self.illegal_char_hostname.sub('_', host_name)
-        if '_GRAPHITE_GROUP' in self.hosts_cache[host_name]:
-            hname = ".".join((self.hosts_cache[host_name]['_GRAPHITE_GROUP'], hname))
-
-        if '_GRAPHITE_PRE' in self.hosts_cache[host_name]:
-            hname = ".".join((self.hosts_cache[host_name]['_GRAPHITE_PRE'], hname))
-
-        if self.hostcheck:
-            hname = '.'.join((hname, self.hostcheck))
-
         # Checks latency
         if self.ignore_latency_limit >= b.data['latency'] > 0:
             check_time = int(b.data['last_chk']) - int(b.data['latency'])
@@ -350,26 +783,145 @@ class Graphite_broker(BaseModule):
         else:
             check_time = int(b.data['last_chk'])
 
-        # Graphite data source
-        if self.graphite_data_source:
-            path = '.'.join((hname, self.graphite_data_source))
-        else:
-            path = hname
+        names = self.get_host_names(host_name, couples)
 
-        lines = []
         # Send a bulk of all metrics at once
-        for (metric, value) in couples:
-            lines.append("%s.%s %s %d" % (path, metric, value, check_time))
-        lines.append("\n")
-        packet = '\n'.join(lines)
+        self.send_metrics(names, [value for (_, value) in couples], check_time)
 
-        self.send_packet(packet)
+    @staticmethod
+    def prepare_brok(brok):
+        brok.prepare()
+
+    def manage_broks(self, broks):
+        """Manage a list of broks received from the broker
+
+        In batch mode, the metrics of all the broks are collected and sent in one packet
+        """
+        if self.batch_broks:
+            self.batch = ([], [], [])
+
+        for brok in broks:
+            self.prepare_brok(brok)
+            self.manage_brok(brok)
+
+        if self.batch_broks:
+            (names, values, timestamps) = self.batch
+            self.batch = None
+            if names:
+                self.send_packet(self.render_packet(names, values, timestamps))
 
     def main(self):
         self.set_proctitle(self.name)
         self.set_exit_handler()
+        if self.profiler:
+            signal.signal(signal.SIGUSR2, self.profiler.start_capture)
+
         while not self.interrupted:
-            message = self.to_q.get()
-            for brok in message:
-                brok.prepare()
-                self.manage_brok(brok)
+            try:
+                message = self.to_q.get(timeout=1)
+            except Empty:
+                # Idle: send the packets left in the cache or the journal
+                if (self.cache or self.journal and self.journal.pending()) and self.connect():
+                    if self.journal:
+                        self.send_journal()
+                    else:
+                        self.flush_cache()
+                if self.profiler:
+                    self.profiler.tick()
+                continue
+            except (IOError, EOFError) as exp:
+                # Interrupted by a signal or broker queue closed
+                if isinstance(exp, EOFError):
+                    logger.error("[Graphite] broker queue is closed, exiting ...")
+                    break
+                continue
+            self.manage_broks(message)
+            if self.profiler:
+                self.profiler.tick()
+
+        self.shutdown()
+
+    def load_spool(self):
+        """Load the packets spooled when the module stopped into the cache, or the journal if enabled"""
+        spool = Journal(self.spool_path)
+        if self.journal:
+            # The cache is not used with the journal, move all the spooled packets to the journal
+            count = 0
+            while spool.pending():
+                packets = spool.read(self.cache_commit_volume)
+                for packet in packets:
+                    self.journal.append(packet)
+                count += len(packets)
+            spool.commit()
+            spool.close()
+            logger.info("[Graphite] moved %d spooled packet(s) to the journal", count)
+            return
+
+        while spool.pending() and len(self.cache) < self.cache_max_length:
+            self.cache.extend(spool.read(min(self.cache_commit_volume, self.cache_max_length - len(self.cache))))
+        # Only the loaded packets are removed from the spool
+        spool.commit()
+        logger.info("[Graphite] loaded %d spooled packet(s) in the module cache", len(self.cache))
+
+        left = 0
+        while spool.pending():
+            left += len(spool.read(self.cache_commit_volume))
+        if left:
+            logger.warning("[Graphite] module cache is full, %d spooled packet(s) not loaded are kept in %s",
+                           left, self.spool_path)
+        spool.close()
+
+    def shutdown(self):
+        """Send the pending data before exiting, within the shutdown timeout
+
+        The packets that could not be sent are spooled if a spool directory is configured.
+        Packets stored in the journal are kept in the journal.
+        """
+        deadline = time.time() + self.shutdown_timeout
+        logger.info("[Graphite] stopping, sending pending data ...")
+
+        if not self.con and not self.connecting and (self.cache or self.journal and self.journal.pending()):
+            self.init(max(deadline - time.time(), 0.001))
+        if self.connecting:
+            # Lazy connection: wait for it to be established
+            self.check_connection(max(deadline - time.time(), 0))
+
+        while self.con and time.time() < deadline:
+            self.con.settimeout(max(deadline - time.time(), 0.001))
+            if self.journal:
+                if not self.journal.pending() or not self.send_journal():
+                    break
+            elif not self.cache or not self.flush_cache():
+                break
+
+        if self.con and self.journal:
+            # Wait for Carbon to acknowledge the sent packets
+            while self.journal_marks and time.time() < deadline:
+                self.commit_journal()
+                time.sleep(0.01)
+
+        if self.con:
+            try:
+                if self.compression == 'gzip':
+                    # Properly terminate the gzip stream
+                    self.con.sendall(self.compressor.flush())
+                elif self.compression == 'lz4':
+                    # Properly terminate the lz4 frame
+                    self.con.sendall(self.frame_header + self.compressor.flush())
+                self.con.close()
+            except IOError as exp:
+                logger.warning("[Graphite] closing connection exception: %s", str(exp))
+            self.con = None
+
+        if self.journal:
+            self.journal.close()
+            logger.info("[Graphite] journal closed, committed position: %s", self.journal.committed)
+        elif self.cache:
+            if self.spool_path:
+                spool = Journal(self.spool_path)
+                for packet in self.cache:
+                    spool.append(packet)
+                spool.close()
+                logger.warning("[Graphite] %d packet(s) not sent, spooled in %s", len(self.cache), self.spool_path)
+            else:
+                logger.warning("[Graphite] %d packet(s) not sent are lost", len(self.cache))
@@ -0,0 +1,146 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2012:
+#    Frederic Mohier, frederic.mohier@gmail.com
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+"""This module provides the hot path profiling of the Graphite broker module:
+per-stage timing histograms regularly dumped to a file and cProfile captures
+started on demand.
+"""
+
+import os
+import time
+import cProfile
+
+from shinken.log import logger
+
+
+class Histogram(object):
+    """Durations histogram with logarithmic buckets, HDR style
+
+    Durations are recorded in microseconds. Each power of 2 range is divided
+    in 2 ** (precision - 1) linear buckets, so a recorded value is known with a
+    relative error lower than 1 / 2 ** (precision - 1).
+    """
+    def __init__(self, precision=5):
+        self.precision = precision
+        self.counts = None
+        self.count = 0
+        self.total = 0.0
+        self.max = 0
+        self.reset()
+
+    def reset(self):
+        self.counts = {}
+        self.count = 0
+        self.total = 0.0
+        self.max = 0
+
+    def record(self, duration):
+        value = int(duration * 1000000)
+        shift = max(value.bit_length() - self.precision, 0)
+        # The bucket key is the lowest value of the bucket
+        bucket = value >> shift << shift
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.count += 1
+        self.total += duration
+        self.max = max(self.max, value)
+
+    def percentile(self, percent):
+        """Get the bucket of the percentile, in microseconds"""
+        if not self.count:
+            return 0
+        rank = self.count * percent / 100.0
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                return bucket
+        return self.max
+
+
+class Profiler(object):
+    """Per-stage timing histograms and on demand cProfile captures
+
+    Histograms are dumped to the profile file every interval seconds and reset.
+    A cProfile capture of duration seconds is dumped to a profile_file.<timestamp>.prof file.
+    """
+    def __init__(self, filename, interval=60, duration=30):
+        self.filename = filename
+        self.interval = interval
+        self.duration = duration
+        self.histograms = {}
+        self.next_dump = time.time() + self.interval
+
+        self.capture = None
+        self.capture_end = 0
+
+    def wrap(self, stage, function):
+        """Get a function recording the duration of each function call in the stage histogram"""
+        histogram = self.histograms.setdefault(stage, Histogram())
+
+        def timed(*args, **kwargs):
+            start = time.time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                histogram.record(time.time() - start)
+        return timed
+
+    def start_capture(self, sig=None, frame=None):  # pylint: disable=unused-argument
+        """Start a cProfile capture, may be used as a signal handler"""
+        if self.capture:
+            logger.info("[Graphite] profiling capture still in progress")
+            return
+
+        logger.info("[Graphite] starting a %d seconds profiling capture", self.duration)
+        self.capture = cProfile.Profile()
+        self.capture_end = time.time() + self.duration
+        self.capture.enable()
+
+    def tick(self):
+        """Dump the histograms and the capture when it is time to"""
+        now = time.time()
+        if self.capture and now >= self.capture_end:
+            self.capture.disable()
+            filename = '%s.%d.prof' % (self.filename, now)
+            self.capture.dump_stats(filename)
+            self.capture = None
+            logger.info("[Graphite] profiling capture dumped to %s", filename)
+
+        if now >= self.next_dump:
+            self.dump()
+            self.next_dump = now + self.interval
+
+    def dump(self):
+        """Write the stages histograms to the profile file and reset them"""
+        lines = ["# %s - durations in microseconds" % time.strftime('%Y-%m-%d %H:%M:%S'),
+                 "%-10s %10s %10s %10s %10s %10s %10s" % ('stage', 'count', 'mean', 'p50', 'p90', 'p99', 'max')]
+        for stage in sorted(self.histograms):
+            histogram = self.histograms[stage]
+            mean = int(histogram.total * 1000000 / histogram.count) if histogram.count else 0
+            lines.append("%-10s %10d %10d %10d %10d %10d %10d" % (
+                stage, histogram.count, mean, histogram.percentile(50), histogram.percentile(90),
+                histogram.percentile(99), histogram.max))
+            # Reset in place, wrapped functions keep a reference to the histogram
+            histogram.reset()
+
+        with open(self.filename + '.tmp', 'w') as profile_file:
+            profile_file.write('\n'.join(lines) + '\n')
+        os.rename(self.filename + '.tmp', self.filename)
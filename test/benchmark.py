@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2012:
+#    Frederic Mohier, frederic.mohier@gmail.com
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Graphite module benchmark
+
+Measures the time needed to manage broks messages of several sizes, brok per brok
+and in batch mode, and the time to first metric with a blocking and a lazy
+connection to Carbon. Run it from the repository root with the same PYTHONPATH as
+the unit tests (see run_tests.sh):
+
+    python test/benchmark.py [message sizes...]
+"""
+
+import sys
+import time
+import socket
+import threading
+
+from shinken.brok import Brok
+from shinken.objects.module import Module
+
+from module.module import Graphite_broker
+
+HOSTS = 100
+SERVICES = 10
+# Maximum time to wait for the first metric
+FIRST_METRIC_TIMEOUT = 10
+
+
+class Sink(threading.Thread):
+    """Carbon stand-in: accept connections and drop the received data"""
+    def __init__(self, port=0):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.server = socket.socket()
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(('127.0.0.1', port))
+        self.server.listen(5)
+        self.port = self.server.getsockname()[1]
+        self.received = 0
+
+    def run(self):
+        while True:
+            con, _ = self.server.accept()
+            while True:
+                data = con.recv(65536)
+                if not data:
+                    break
+                self.received += len(data)
+            con.close()
+
+
+def get_broker(port, connect=True, **parameters):
+    mod_conf = {
+        'module_name': 'Graphite-Perfdata',
+        'module_type': 'graphite_perfdata',
+        'host': '127.0.0.1',
+        'port': str(port),
+        'graphite_data_source': 'shinken',
+    }
+    mod_conf.update(parameters)
+    broker = Graphite_broker(Module(mod_conf))
+    if connect:
+        broker.init()
+
+    broks = []
+    for host in range(HOSTS):
+        host_name = 'host_%d' % host
+        broks.append(Brok('initial_host_status', {'host_name': host_name, 'customs': {}}))
+        for service in range(SERVICES):
+            broks.append(Brok('initial_service_status', {
+                'host_name': host_name, 'service_description': 'service_%d' % service, 'customs': {}
+            }))
+    broker.manage_broks(broks)
+    return broker
+
+
+def get_message(count):
+    now = int(time.time())
+    broks = []
+    for index in range(count):
+        broks.append(Brok('service_check_result', {
+            'host_name': 'host_%d' % (index % HOSTS),
+            'service_description': 'service_%d' % (index / HOSTS % SERVICES),
+            'perf_data': 'time=0.%03ds;1;2;0;10 size=%dB;;;0' % (index % 999 + 1, index + 1),
+            'state_id': 0, 'latency': 0.1, 'execution_time': 0.2, 'last_chk': now
+        }))
+    return broks
+
+
+def bench_message(port, count, batch):
+    broker = get_broker(port, batch_broks=str(int(batch)))
+    message = get_message(count)
+
+    start = time.time()
+    broker.manage_broks(message)
+    return time.time() - start
+
+
+def bench_first_metric(port, lazy):
+    """Time from the module connection to the first metric received by Carbon"""
+    sink = Sink(port)
+    sink.start()
+    broker = get_broker(sink.port, connect=False, lazy_connect=str(int(lazy)))
+    message = get_message(1)
+
+    start = time.time()
+    broker.init()
+    broker.manage_broks(message)
+    while not sink.received:
+        if time.time() - start > FIRST_METRIC_TIMEOUT:
+            raise RuntimeError("no metric received by Carbon after %d seconds" % FIRST_METRIC_TIMEOUT)
+        # Send the cached metric when the connection is established, as the module main loop does
+        if broker.cache and broker.connect():
+            broker.flush_cache()
+        time.sleep(0.0001)
+    return time.time() - start
+
+
+def main(sizes):
+    sink = Sink()
+    sink.start()
+
+    print("%10s %12s %12s %8s" % ('broks', 'per brok (s)', 'batch (s)', 'speedup'))
+    for count in sizes:
+        per_brok = bench_message(sink.port, count, False)
+        batch = bench_message(sink.port, count, True)
+        print("%10d %12.4f %12.4f %8.2f" % (count, per_brok, batch, per_brok / batch))
+
+    print("\n%10s %12s" % ('connection', 'first metric (s)'))
+    for lazy in (False, True):
+        print("%10s %12.4f" % ('lazy' if lazy else 'blocking', bench_first_metric(0, lazy)))
+
+
+if __name__ == '__main__':
+    main([int(size) for size in sys.argv[1:]] or [1000, 10000, 100000])
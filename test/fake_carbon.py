@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2012:
+#    Frederic Mohier, frederic.mohier@gmail.com
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+"""In-process Carbon receiver stand-in for the tests
+
+The receiver accepts plaintext or pickle connections, optionally gzip
+compressed, and stores the received metrics. Degraded Carbon conditions can
+be injected on demand:
+
+    - receive_buffer: socket receive buffer size (backpressure on the sender)
+    - read_delay: seconds to wait before each read (slow consumer)
+    - read_size: maximum bytes for each read (throttled reads)
+    - reset(): reset the established connections
+    - outage(): refuse the new connections until outage(False)
+"""
+
+import time
+import zlib
+import struct
+import socket
+import cPickle
+import threading
+
+
+class FakeCarbon(object):
+    def __init__(self, port=0, protocol='plaintext', compression='none', receive_buffer=0):
+        self.host = '127.0.0.1'
+        self.port = port
+        self.protocol = protocol
+        self.compression = compression
+        self.receive_buffer = receive_buffer
+
+        self.read_delay = 0
+        self.read_size = 65536
+
+        # Received (path, value, timestamp) metrics
+        self.metrics = []
+        self.received_bytes = 0
+        self.connections = 0
+        self.lock = threading.Lock()
+
+        self.server = None
+        # Established connections and their reader thread
+        self.clients = {}
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.server = socket.socket()
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.receive_buffer:
+            # Inherited by the accepted connections
+            self.server.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.receive_buffer)
+        self.server.bind((self.host, self.port))
+        self.server.listen(5)
+        self.server.settimeout(0.05)
+        # Keep the same port when restarting after an outage
+        self.port = self.server.getsockname()[1]
+
+        self.running = True
+        self.thread = threading.Thread(target=self._accept)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+        self.server.close()
+        self.reset()
+
+    def reset(self):
+        """Reset (TCP RST) the established connections"""
+        with self.lock:
+            clients, self.clients = self.clients, {}
+        for (client, reader) in clients.items():
+            try:
+                # Closing with a zero linger time sends a RST. The reader thread closes the
+                # connection when its blocking read is interrupted
+                client.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+                client.shutdown(socket.SHUT_RD)
+            except socket.error:
+                pass
+            reader.join()
+
+    def outage(self, down=True):
+        """Start (refuse connections and reset the established ones) or stop an outage"""
+        if down:
+            self.stop()
+        else:
+            self.start()
+
+    def wait_for(self, count, timeout=5.0):
+        """Wait for at least count received metrics, returns False on timeout"""
+        end = time.time() + timeout
+        while len(self.metrics) < count:
+            if time.time() > end:
+                return False
+            time.sleep(0.005)
+        return True
+
+    def _accept(self):
+        while self.running:
+            try:
+                client, _ = self.server.accept()
+            except socket.timeout:
+                continue
+            except socket.error:
+                break
+            client.settimeout(None)
+            reader = threading.Thread(target=self._read, args=(client,))
+            reader.daemon = True
+            with self.lock:
+                self.clients[client] = reader
+                self.connections += 1
+            reader.start()
+
+    def _read(self, client):
+        decompressor = None
+        if self.compression == 'gzip':
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+        data = ''
+        while True:
+            if self.read_delay:
+                time.sleep(self.read_delay)
+            try:
+                chunk = client.recv(self.read_size)
+            except socket.error:
+                break
+            if not chunk:
+                break
+            self.received_bytes += len(chunk)
+            if decompressor:
+                chunk = decompressor.decompress(chunk)
+            data = self._parse(data + chunk)
+
+        with self.lock:
+            self.clients.pop(client, None)
+        client.close()
+
+    def _parse(self, data):
+        """Store the complete metrics of data, returns the remaining incomplete data"""
+        metrics = []
+        if self.protocol == 'pickle':
+            while len(data) >= 4:
+                length = struct.unpack('!L', data[:4])[0]
+                if len(data) < 4 + length:
+                    break
+                for (path, (timestamp, value)) in cPickle.loads(data[4:4 + length]):
+                    metrics.append((path, float(value), int(timestamp)))
+                data = data[4 + length:]
+        else:
+            lines = data.split('\n')
+            data = lines.pop()
+            for line in lines:
+                if line:
+                    (path, value, timestamp) = line.split(' ')
+                    metrics.append((path, float(value), int(timestamp)))
+
+        with self.lock:
+            self.metrics.extend(metrics)
+        return data
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2012:
+#    Frederic Mohier, frederic.mohier@gmail.com
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken. If not, see <http://www.gnu.org/licenses/>.
+
+import time
+import shutil
+import socket
+import struct
+import cPickle
+import tempfile
+from socket import setdefaulttimeout
+from shinken_test import *
+
+from fake_carbon import FakeCarbon
+
+
+# Default socket timeout duration
+setdefaulttimeout(3.0)
+
+
+class TestLoadGraphite(unittest.TestCase):
+    """Load tests of the packets sending with a degraded Carbon"""
+    def setUp(self):
+        self.carbon = FakeCarbon().start()
+        self.journal_path = None
+
+    def tearDown(self):
+        self.carbon.stop()
+        if self.journal_path:
+            shutil.rmtree(self.journal_path)
+
+    def get_broker(self, **parameters):
+        mod_conf = {
+            'module_name': 'Graphite-Perfdata',
+            'module_type': 'graphite_perfdata',
+            'host': self.carbon.host,
+            'port': str(self.carbon.port),
+            'cache_max_length': '100000',
+            'cache_commit_volume': '100',
+        }
+        mod_conf.update(parameters)
+        module = modulesctx.get_module('graphite')
+        broker = module.get_instance(Module(mod_conf))
+        broker.init()
+        return broker
+
+    @staticmethod
+    def send(broker, start, count):
+        """Send count packets of one metric, the metric value is the packet index"""
+        now = int(time.time())
+        for index in range(start, start + count):
+            broker.send_packet('load.test.metric_%d %d %d\n' % (index % 100, index, now))
+
+    def drain(self, broker):
+        """Send the packets remaining in the module cache or journal"""
+        end = time.time() + 5
+        while time.time() < end:
+            if broker.journal:
+                if not broker.journal.pending():
+                    break
+                broker.send_journal()
+            else:
+                if not broker.cache:
+                    break
+                if broker.connect():
+                    broker.flush_cache()
+
+    def check(self, name, count, begin):
+        """Check that all the packets are received and report the delivery throughput"""
+        self.assertTrue(self.carbon.wait_for(count, timeout=10))
+        elapsed = time.time() - begin
+        received = set(int(value) for (_, value, _) in self.carbon.metrics)
+        print("%s: %d packets in %.3fs (%d packets/s), %d received (%d duplicates), %d connection(s)"
+              % (name, count, elapsed, count / max(elapsed, 0.000001), len(received),
+                 len(self.carbon.metrics) - len(received), self.carbon.connections))
+        self.assertEqual(received, set(range(count)))
+
+    def test_nominal(self):
+        broker = self.get_broker()
+        begin = time.time()
+        self.send(broker, 0, 5000)
+        self.check('nominal', 5000, begin)
+
+    def test_slow_consumer(self):
+        """Carbon reads slowly, small chunks"""
+        self.carbon.stop()
+        self.carbon = FakeCarbon(receive_buffer=4096).start()
+        self.carbon.read_delay = 0.001
+        self.carbon.read_size = 512
+
+        broker = self.get_broker()
+        begin = time.time()
+        self.send(broker, 0, 5000)
+        self.drain(broker)
+        self.check('slow consumer', 5000, begin)
+
+    def _reset(self, name, **parameters):
+        broker = self.get_broker(**parameters)
+        begin = time.time()
+        self.send(broker, 0, 1000)
+        self.assertTrue(self.carbon.wait_for(1000))
+
+        self.carbon.reset()
+        self.send(broker, 1000, 1000)
+        self.drain(broker)
+        self.check(name, 2000, begin)
+        self.assertEqual(self.carbon.connections, 2)
+
+    def test_reset(self):
+        """Carbon resets the connection"""
+        self._reset('reset')
+
+    def test_reset_journal(self):
+        """Carbon resets the connection, packets are sent from the journal"""
+        self.journal_path = tempfile.mkdtemp()
+        self._reset('reset with journal', journal_path=self.journal_path)
+
+    def test_reset_compression(self):
+        """Carbon resets the connection of a compressed stream"""
+        self.carbon.compression = 'gzip'
+        self._reset('reset with compression', compression='gzip')
+
+    def test_outage(self):
+        """Carbon is not available for a while"""
+        broker = self.get_broker()
+        begin = time.time()
+        self.send(broker, 0, 500)
+        self.assertTrue(self.carbon.wait_for(500))
+
+        self.carbon.outage()
+        outage = time.time()
+        self.send(broker, 500, 500)
+        self.assertEqual(len(broker.cache), 500)
+        print("outage: 500 packets cached in %.3fs" % (time.time() - outage))
+
+        self.carbon.outage(False)
+        self.send(broker, 1000, 500)
+        self.drain(broker)
+        self.check('outage', 1500, begin)
+
+    def test_pickle_receiver(self):
+        """The stand-in also receives the pickle protocol"""
+        self.carbon.protocol = 'pickle'
+        now = int(time.time())
+        payload = cPickle.dumps([('load.test.metric_%d' % index, (now, index)) for index in range(10)],
+                                protocol=2)
+        client = socket.create_connection((self.carbon.host, self.carbon.port))
+        client.sendall(struct.pack('!L', len(payload)) + payload)
+        client.close()
+        self.check('pickle', 10, time.time())
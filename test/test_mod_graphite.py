@@ -21,7 +21,10 @@
 # along with Shinken. If not, see <http://www.gnu.org/licenses/>.
 
 import time
+import shutil
 import socket
+import tempfile
+import zlib
 from socket import setdefaulttimeout
 import select
 import struct
@@ -29,6 +32,12 @@ import cPickle
 import pytest
 from shinken_test import *
 
+# lz4 is an optional dependency of the module
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
 
 # Default socket timeout duration
 setdefaulttimeout(3.0)
@@ -193,6 +202,38 @@ class TestModGraphite(ShinkenTest):
         # 2 is timestamp
         self.assertTrue(int(data[2]) == last - 5)
 
+    def test_batch_broks(self):
+        self.print_header()
+
+        host = self.sched.hosts.find_by_name("test_host_0")
+        host.checks_in_progress = []
+        host.act_depend_of = []  # ignore the router
+        svc = self.sched.services.find_srv_by_name_and_hostname("test_host_0", "test_ok_0")
+        svc.checks_in_progress = []
+        svc.act_depend_of = []  # no parent host checks on critical check results
+
+        self.scheduler_loop(1, [[host, 0, 'UP | rta=0.1']], do_sleep=True, sleep_time=0.1)
+        self.scheduler_loop(1, [[svc, 0, 'OK | time=1s;3;4;5;6']], do_sleep=True, sleep_time=0.1)
+        self.scheduler_loop(1, [[svc, 0, 'OK | val=1k;4;5;6;7']], do_sleep=True, sleep_time=0.1)
+
+        # All the broks of a message are sent in one packet
+        self.graphite_broker.batch_broks = True
+        self.graphite_broker.manage_broks(self.sched.brokers['Default-Broker']['broks'])
+        self.sched.brokers['Default-Broker']['broks'] = []
+        self.assertIsNone(self.graphite_broker.batch)
+
+        try:
+            output = self.conn_serv.recv(8192)
+        except socket.timeout:
+            self.assertFalse
+        lines = output.split('\n')
+        print("data: %s" % lines)
+        # 3 metrics and a single packet end
+        self.assertTrue(len(lines) == 5)
+        metrics = [line.split(' ')[0] for line in lines if line]
+        assert metrics == ['test_host_0.rta', 'test_host_0.test_ok_0.time', 'test_host_0.test_ok_0.val']
+
+
 class TestModGraphiteConfiguration(ShinkenTest):
     def do_load_modules(self):
         self.modules_manager.load_and_init()
@@ -261,7 +302,7 @@ class TestModGraphiteConfiguration(ShinkenTest):
         if self.sock_serv:
             self.sock_serv.close()
 
-    def _configure_and_raise_metrics(self, mod_conf, initial=True, expected=1):
+    def _configure_and_raise_metrics(self, mod_conf, initial=True, expected=1, decompress=None):
         # All default parameters
         modconf = Module(mod_conf)
         module = modulesctx.get_module('graphite')
@@ -319,6 +360,8 @@ class TestModGraphiteConfiguration(ShinkenTest):
                 return
             self.assertFalse
 
+        if decompress:
+            output = decompress(output)
         output = output.split('\n')
         lines = [l for l in output if l]
         print("data lines: (%d lines) - %s\nexpecting %d lines" % (len(lines), lines, expected))
@@ -334,6 +377,8 @@ class TestModGraphiteConfiguration(ShinkenTest):
             # 2 is timestamp
             self.assertTrue(len(data) == 3)
 
+        return lines
+
     def test_unknown(self):
         """Unknown host/service"""
         self.print_header()
@@ -432,6 +477,405 @@ class TestModGraphiteConfiguration(ShinkenTest):
 
         assert self.graphite_broker.filtered_metrics == {'cpu': ['1m', '5m'], 'mem': ['3z']}
 
+    def test_metadata(self):
+        """Send check results metadata"""
+        self.print_header()
+
+        # All default parameters + metadata
+        lines = self._configure_and_raise_metrics({
+            'module_name': 'Graphite-Perfdata',
+            'module_type': 'graphite_perfdata',
+            'port': '12345',
+            'host': '127.0.0.1',
+            'cache_max_length': 1000,
+            'cache_commit_volume': 100,
+            'graphite_data_source': 'shinken',
+            'hostcheck': '__HOST__',
+            'filter': '',
+            'ignore_latency_limit': '15',
+            # Here!
+            'send_state': '1',
+            'send_latency': '0',
+            'send_execution_time': '1'
+        }, expected=9)
+
+        metrics = [line.split(' ')[0] for line in lines]
+        assert 'host_pre.host_group.test_host_0.__HOST__.shinken.shinken_state' in metrics
+        assert 'host_pre.host_group.test_host_0.shinken.test_ok_0.svc_post.shinken_execution_time' in metrics
+        for metric in metrics:
+            assert not metric.endswith('shinken_latency')
+
+    def test_journal(self):
+        """Journal with acknowledged packets"""
+        self.print_header()
+
+        journal_path = tempfile.mkdtemp()
+        try:
+            # All default parameters + journal
+            self._configure_and_raise_metrics({
+                'module_name': 'Graphite-Perfdata',
+                'module_type': 'graphite_perfdata',
+                'port': '12345',
+                'host': '127.0.0.1',
+                'cache_max_length': 1000,
+                'cache_commit_volume': 100,
+                'graphite_data_source': 'shinken',
+                'hostcheck': '__HOST__',
+                'filter': '',
+                'ignore_latency_limit': '15',
+                # Here!
+                'journal_path': journal_path
+            }, expected=3)
+
+            journal = self.graphite_broker.journal
+            self.assertIsNotNone(journal)
+            self.assertFalse(journal.pending())
+            sent_position = journal.position
+
+            # Raise a new check result, the previous packets are acknowledged and committed
+            host = self.sched.hosts.find_by_name("test_host_0")
+            self.scheduler_loop(1, [[host, 0, 'UP | rta=0.1']], do_sleep=True, sleep_time=0.1)
+            self.update_broker()
+            self.assertEqual(journal.committed, sent_position)
+            self.assertTrue(os.path.exists(os.path.join(journal_path, 'offset')))
+
+            # The last packet is not yet committed and is sent again after a module restart
+            self.graphite_broker.journal.close()
+            module = modulesctx.get_module('graphite')
+            restarted = module.get_instance(Module({
+                'module_name': 'Graphite-Perfdata',
+                'module_type': 'graphite_perfdata',
+                'port': '12345',
+                'host': '127.0.0.1',
+                'journal_path': journal_path
+            }))
+            self.assertEqual(restarted.journal.committed, journal.committed)
+            self.assertTrue(restarted.journal.pending())
+            packets = restarted.journal.read(10)
+            self.assertEqual(len(packets), 1)
+            assert packets[0].startswith('host_pre.host_group.test_host_0.__HOST__.shinken.rta 0.1 ')
+            restarted.journal.close()
+        finally:
+            shutil.rmtree(journal_path)
+
+    def test_compression(self):
+        """Gzip compressed transport"""
+        self.print_header()
+
+        # Decompress as a Carbon relay gzip receiver
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+        # All default parameters + compression
+        lines = self._configure_and_raise_metrics({
+            'module_name': 'Graphite-Perfdata',
+            'module_type': 'graphite_perfdata',
+            'port': '12345',
+            'host': '127.0.0.1',
+            'cache_max_length': 1000,
+            'cache_commit_volume': 100,
+            'graphite_data_source': 'shinken',
+            'hostcheck': '__HOST__',
+            'filter': '',
+            'ignore_latency_limit': '15',
+            # Here!
+            'compression': 'gzip',
+            'compression_level': '9'
+        }, expected=3, decompress=decompressor.decompress)
+
+        self.assertEqual(self.graphite_broker.compression, 'gzip')
+        metrics = [line.split(' ')[0] for line in lines]
+        assert metrics == [
+            'host_pre.host_group.test_host_0.__HOST__.shinken.rta',
+            'host_pre.host_group.test_host_0.shinken.test_ok_0.svc_post.time',
+            'host_pre.host_group.test_host_0.shinken.test_ok_0.svc_post.val'
+        ]
+
+    @pytest.mark.skipif(lz4 is None, reason="lz4 library is not installed")
+    def test_compression_lz4(self):
+        """Lz4 compressed transport"""
+        self.print_header()
+
+        # Decompress as a Carbon relay lz4 receiver, one frame for the connection
+        decompressor = lz4.frame.LZ4FrameDecompressor()
+
+        # All default parameters + compression
+        lines = self._configure_and_raise_metrics({
+            'module_name': 'Graphite-Perfdata',
+            'module_type': 'graphite_perfdata',
+            'port': '12345',
+            'host': '127.0.0.1',
+            'cache_max_length': 1000,
+            'cache_commit_volume': 100,
+            'graphite_data_source': 'shinken',
+            'hostcheck': '__HOST__',
+            'filter': '',
+            'ignore_latency_limit': '15',
+            # Here!
+            'compression': 'lz4'
+        }, expected=3, decompress=decompressor.decompress)
+
+        self.assertEqual(self.graphite_broker.compression, 'lz4')
+        # Fast mode by default
+        self.assertEqual(self.graphite_broker.compression_level, 0)
+        metrics = [line.split(' ')[0] for line in lines]
+        assert metrics == [
+            'host_pre.host_group.test_host_0.__HOST__.shinken.rta',
+            'host_pre.host_group.test_host_0.shinken.test_ok_0.svc_post.time',
+            'host_pre.host_group.test_host_0.shinken.test_ok_0.svc_post.val'
+        ]
+
+    def test_profiling(self):
+        """Hot path profiling"""
+        self.print_header()
+
+        profile_path = tempfile.mkdtemp()
+        profile_file = os.path.join(profile_path, 'graphite.profile')
+        try:
+            # All default parameters + profiling
+            self._configure_and_raise_metrics({
+                'module_name': 'Graphite-Perfdata',
+                'module_type': 'graphite_perfdata',
+                'port': '12345',
+                'host': '127.0.0.1',
+                'cache_max_length': 1000,
+                'cache_commit_volume': 100,
+                'graphite_data_source': 'shinken',
+                'hostcheck': '__HOST__',
+                'filter': '',
+                'ignore_latency_limit': '15',
+                # Here!
+                'profile_file': profile_file,
+                'profile_duration': '0'
+            }, expected=3)
+
+            profiler = self.graphite_broker.profiler
+            self.assertIsNotNone(profiler)
+            self.assertEqual(profiler.histograms['send'].count, 3)
+            self.assertEqual(profiler.histograms['path'].count, 3)
+
+            profiler.dump()
+            with open(profile_file) as f:
+                lines = f.read().splitlines()
+            stages = [line.split()[0] for line in lines[2:]]
+            assert stages == ['parse', 'path', 'prepare', 'send']
+            self.assertEqual(profiler.histograms['send'].count, 0)
+
+            # cProfile capture
+            profiler.start_capture()
+            self.graphite_broker.manage_broks([])
+            profiler.tick()
+            self.assertIsNone(profiler.capture)
+            assert [f for f in os.listdir(profile_path) if f.endswith('.prof')]
+        finally:
+            shutil.rmtree(profile_path)
+
+    def test_lazy_connect(self):
+        """Asynchronous connection"""
+        self.print_header()
+
+        # All default parameters + lazy connection
+        self._configure_and_raise_metrics({
+            'module_name': 'Graphite-Perfdata',
+            'module_type': 'graphite_perfdata',
+            'port': '12345',
+            'host': '127.0.0.1',
+            'cache_max_length': 1000,
+            'cache_commit_volume': 100,
+            'graphite_data_source': 'shinken',
+            'hostcheck': '__HOST__',
+            'filter': '',
+            'ignore_latency_limit': '15',
+            # Here!
+            'lazy_connect': '1'
+        }, expected=3)
+
+        self.assertIsNone(self.graphite_broker.connecting)
+        self.assertIsNotNone(self.graphite_broker.con)
+
+        # No connection when stopping, cached packets are sent on a new connection
+        self.graphite_broker.con.close()
+        self.graphite_broker.con = None
+        self.graphite_broker.cache.append('test_host_0.__HOST__.shinken.rta 0.1 1578335088\n')
+        self.graphite_broker.shutdown()
+        self.assertEqual(len(self.graphite_broker.cache), 0)
+        self.conn_serv.close()
+        self.conn_serv, _ = self.sock_serv.accept()
+        self.assertEqual(self.conn_serv.recv(8192), 'test_host_0.__HOST__.shinken.rta 0.1 1578335088\n')
+
+    def test_shutdown(self):
+        """Send or spool pending data when stopping"""
+        self.print_header()
+
+        spool_path = tempfile.mkdtemp()
+        try:
+            # All default parameters + spool
+            self._configure_and_raise_metrics({
+                'module_name': 'Graphite-Perfdata',
+                'module_type': 'graphite_perfdata',
+                'port': '12345',
+                'host': '127.0.0.1',
+                'cache_max_length': 1000,
+                'cache_commit_volume': 1,
+                'graphite_data_source': 'shinken',
+                'hostcheck': '__HOST__',
+                'filter': '',
+                'ignore_latency_limit': '15',
+                # Here!
+                'shutdown_timeout': '2',
+                'spool_path': spool_path
+            }, expected=3)
+
+            # Cached packets are sent when stopping
+            self.graphite_broker.cache.append('test_host_0.__HOST__.shinken.rta 0.1 1578335088\n')
+            self.graphite_broker.cache.append('test_host_0.__HOST__.shinken.rta 0.2 1578335089\n')
+            self.graphite_broker.shutdown()
+            self.assertIsNone(self.graphite_broker.con)
+            self.assertEqual(len(self.graphite_broker.cache), 0)
+            output = ''
+            while True:
+                data = self.conn_serv.recv(8192)
+                if not data:
+                    break
+                output += data
+            lines = [l for l in output.split('\n') if l]
+            self.assertEqual(len(lines), 2)
+
+            # Carbon is not available, cached packets are spooled ...
+            self.sock_serv.close()
+            self.sock_serv = None
+            self.graphite_broker.cache.append('test_host_0.__HOST__.shinken.rta 0.3 1578335090\n')
+            self.graphite_broker.shutdown()
+
+            # ... and loaded in the cache when the module restarts
+            module = modulesctx.get_module('graphite')
+            restarted = module.get_instance(Module({
+                'module_name': 'Graphite-Perfdata',
+                'module_type': 'graphite_perfdata',
+                'port': '12345',
+                'host': '127.0.0.1',
+                'spool_path': spool_path
+            }))
+            self.assertEqual(list(restarted.cache), ['test_host_0.__HOST__.shinken.rta 0.3 1578335090\n'])
+
+            # Spooled again, then moved to the journal when the module restarts with a journal
+            restarted.shutdown()
+            journal_path = tempfile.mkdtemp()
+            try:
+                restarted = module.get_instance(Module({
+                    'module_name': 'Graphite-Perfdata',
+                    'module_type': 'graphite_perfdata',
+                    'port': '12345',
+                    'host': '127.0.0.1',
+                    'spool_path': spool_path,
+                    'journal_path': journal_path
+                }))
+                self.assertEqual(len(restarted.cache), 0)
+                self.assertEqual(restarted.journal.read(10), ['test_host_0.__HOST__.shinken.rta 0.3 1578335090\n'])
+                restarted.journal.close()
+            finally:
+                shutil.rmtree(journal_path)
+        finally:
+            shutil.rmtree(spool_path)
+
+    def test_cardinality_guard(self):
+        """Limit the number of distinct metrics of a service"""
+        self.print_header()
+
+        # All default parameters + cardinality guard
+        lines = self._configure_and_raise_metrics({
+            'module_name': 'Graphite-Perfdata',
+            'module_type': 'graphite_perfdata',
+            'port': '12345',
+            'host': '127.0.0.1',
+            'cache_max_length': 1000,
+            'cache_commit_volume': 100,
+            'graphite_data_source': 'shinken',
+            'hostcheck': '__HOST__',
+            'filter': '',
+            'ignore_latency_limit': '15',
+            # Here!
+            'max_metrics_per_service': '1'
+        }, expected=2)
+
+        # The second distinct metric of the service is dropped
+        metrics = [line.split(' ')[0] for line in lines]
+        assert 'host_pre.host_group.test_host_0.shinken.test_ok_0.svc_post.val' not in metrics
+        self.assertEqual(self.graphite_broker.dropped_metrics['cardinality'], 1)
+
+    def test_rate_limit(self):
+        """Limit the metrics rate of an host"""
+        self.print_header()
+
+        # All default parameters + rate limit
+        self._configure_and_raise_metrics({
+            'module_name': 'Graphite-Perfdata',
+            'module_type': 'graphite_perfdata',
+            'port': '12345',
+            'host': '127.0.0.1',
+            'cache_max_length': 1000,
+            'cache_commit_volume': 100,
+            'graphite_data_source': 'shinken',
+            'hostcheck': '__HOST__',
+            'filter': '',
+            'ignore_latency_limit': '15',
+            # Here!
+            'host_rate_limit': '0.001',
+            'host_rate_burst': '2'
+        }, expected=2)
+
+        self.assertEqual(self.graphite_broker.dropped_metrics['rate'], 1)
+
+    def test_rate_limit_low(self):
+        """Limit the metrics rate of an host under one metric per minute"""
+        self.print_header()
+
+        # All default parameters + rate limit, the default burst is lower than 1 metric
+        self._configure_and_raise_metrics({
+            'module_name': 'Graphite-Perfdata',
+            'module_type': 'graphite_perfdata',
+            'port': '12345',
+            'host': '127.0.0.1',
+            'cache_max_length': 1000,
+            'cache_commit_volume': 100,
+            'graphite_data_source': 'shinken',
+            'hostcheck': '__HOST__',
+            'filter': '',
+            'ignore_latency_limit': '15',
+            # Here!
+            'host_rate_limit': '0.01'
+        }, expected=1)
+
+        self.assertEqual(self.graphite_broker.host_rate_burst, 1.0)
+        self.assertEqual(self.graphite_broker.dropped_metrics['rate'], 2)
+
+    def test_tagged_series(self):
+        """Graphite 1.1 tagged series"""
+        self.print_header()
+
+        # All default parameters + tagged series
+        lines = self._configure_and_raise_metrics({
+            'module_name': 'Graphite-Perfdata',
+            'module_type': 'graphite_perfdata',
+            'port': '12345',
+            'host': '127.0.0.1',
+            'cache_max_length': 1000,
+            'cache_commit_volume': 100,
+            'graphite_data_source': 'shinken',
+            'hostcheck': '__HOST__',
+            'filter': '',
+            'ignore_latency_limit': '15',
+            # Here!
+            'graphite_tags': '1'
+        }, expected=3)
+
+        self.assertTrue(self.graphite_broker.graphite_tags)
+        metrics = [line.split(' ')[0] for line in lines]
+        assert metrics == [
+            'host_pre.shinken.rta;host=test_host_0;group=host_group;service=__HOST__',
+            'host_pre.shinken.time;host=test_host_0;group=host_group;service=test_ok_0;post=svc_post',
+            'host_pre.shinken.val;host=test_host_0;group=host_group;service=test_ok_0;post=svc_post'
+        ]
+
     # @pytest.mark.skip("Not yet...")
     def test_cache(self):
         """Filter some services"""